@@ -7,21 +7,70 @@ import logging
 import json
 import nbformat
 import os
+import zlib
 from jupyter_copilot.lsp import LSPWrapper
 from jupyter_server.base.handlers import JupyterHandler
 
+# how long a notebook manager is kept after its socket drops without a clean close
+# a client reconnecting within this window resumes from the in memory state
+SESSION_RETAIN_SECONDS = 120
+
+# notebook managers by client session id, along with the pending release timers
+notebook_sessions: Dict[str, "NotebookManager"] = {}
+release_timers: Dict[str, object] = {}
+
+
+def hash_cell_content(content: str) -> str:
+    """
+    crc32 of the utf-8 encoded cell content prefixed with its byte length
+    this has to match hashCellContent in src/utils.ts
+    """
+    try:
+        data = content.encode("utf-8")
+    except UnicodeEncodeError:
+        # lone surrogates can come through json from the browser, TextEncoder turns them
+        # into U+FFFD so do the same here to keep both sides hashing the same bytes
+        data = content.encode("utf-16", "surrogatepass").decode("utf-16", "replace").encode("utf-8")
+    return f"{len(data)}-{zlib.crc32(data):08x}"
+
+
+def release_notebook_session(session_id: str) -> None:
+    """ closes the document in the lsp server and forgets the retained notebook manager """
+    timer = release_timers.pop(session_id, None)
+    if timer is not None:
+        IOLoop.current().remove_timeout(timer)
+
+    notebook_manager = notebook_sessions.pop(session_id, None)
+    if notebook_manager is None:
+        return
+
+    notebook_manager.send_close_signal()
+    lsp_client.unregister_restart_callback(notebook_manager._callback)
+    logging.debug("[Copilot] Released notebook session %s", session_id)
+
+
+def get_sessions_for_path(path: str, exclude: str = '') -> Dict[str, "NotebookManager"]:
+    """ returns the other notebook sessions that have the notebook at path open """
+    return {
+        session_id: notebook_manager for session_id, notebook_manager in notebook_sessions.items()
+        if notebook_manager.path == path and session_id != exclude
+    }
+
+
 class NotebookManager:
     """ 
     class managing the content of the notebook in memory 
     notebook code is stored in an array of strings, each string representing a cell
     on an update we update the cell index in the array
     """
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, document_version: int = 0) -> None:
         self.path = path
         # remove leading slash for name
         self.name = path[1:] if path.startswith("/") else path
-        self.document_version = 0
+        self.document_version = document_version
         self.language = "python"
+        # the websocket handler currently attached to this notebook, if any
+        self.owner: Any = None
         self.notebook_cells = self.load_notebook()
 
         # callback to run if the lsp server is ever restarted
@@ -55,14 +104,7 @@ class NotebookManager:
         if nb.metadata and nb.metadata.kernelspec:
             self.language = nb.metadata.kernelspec.language.lower()
 
-        lsp_client.send_notification("textDocument/didOpen", {
-            "textDocument": {
-                "uri": f"file:///{self.name}",
-                "languageId": self.language,
-                "version": self.document_version,
-                "text": "".join(code)
-            }
-        })
+        self.send_open_signal("".join(code))
 
         return code
 
@@ -98,6 +140,38 @@ class NotebookManager:
         else:
             logging.error(f"Cell {cell_id} does not exist")
 
+    def get_cell_hashes(self) -> List[str]:
+        """ return a content hash for each cell so a client can find which cells differ """
+        return [hash_cell_content(cell) for cell in self.notebook_cells]
+
+    def sync_cells(self, cells: List[Dict[str, Any]], cell_count: int) -> bool:
+        """
+        applies the cells a client found to differ after comparing hashes
+        the array is resized to cell_count first, returns whether anything changed
+        """
+        if not isinstance(cell_count, int) or isinstance(cell_count, bool) or cell_count < 0:
+            logging.error(f"Invalid cell count {cell_count}")
+            return False
+
+        changed = len(self.notebook_cells) != cell_count
+        del self.notebook_cells[cell_count:]
+        for _ in range(cell_count - len(self.notebook_cells)):
+            self.notebook_cells.append('')
+
+        for cell in cells:
+            cell_id = cell['cell_id']
+            if not isinstance(cell_id, int) or not 0 <= cell_id < cell_count:
+                logging.error(f"Cell {cell_id} does not exist")
+                continue
+            if not isinstance(cell['content'], str):
+                logging.error(f"Invalid content for cell {cell_id}")
+                continue
+            if self.notebook_cells[cell_id] != cell['content']:
+                self.notebook_cells[cell_id] = cell['content']
+                changed = True
+
+        return changed
+
     def get_full_code(self) -> str:
         """ return the full code of the notebook as a string """
         return "\n\n".join(self.notebook_cells)
@@ -147,17 +221,21 @@ class NotebookManager:
         self.path = path
         self.name = path[1:] if path.startswith("/") else path
 
+        self.send_open_signal(self.get_full_code())
+
+        logging.debug(f"[Copilot] Path changed to {self.path}")
+
+    def send_open_signal(self, text: str) -> None:
+        """ send an open signal to the lsp server """
         lsp_client.send_notification("textDocument/didOpen", {
             "textDocument": {
                 "uri": f"file:///{self.name}",
                 "languageId": self.language,
                 "version": self.document_version,
-                "text": self.get_full_code()
+                "text": text
             }
         })
 
-        logging.debug(f"[Copilot] Path changed to {self.path}")
-
     def send_close_signal(self) -> None:
         """ send a close signal to the lsp server """
         logging.debug("[Copilot] Sending close signal to LSP for %s", self.path)
@@ -174,20 +252,14 @@ class NotebookManager:
         """
         self.language = language
         self.send_close_signal( )
-        lsp_client.send_notification("textDocument/didOpen", {
-            "textDocument": {
-                "uri": f"file:///{self.name}",
-                "languageId": self.language,
-                "version": self.document_version,
-                "text": self.get_full_code()
-            }
-        })
+        self.send_open_signal(self.get_full_code())
         logging.debug(f"[Copilot] Language set to {language}")
 
 
 class NotebookLSPHandler(WebSocketHandler):
     def initialize(self):
         self.notebook_manager: NotebookManager | None = None
+        self.session_id = ''
         # we need a queue so that we can fully process one request before moving onto the next
         self.message_queue = asyncio.Queue()
         # register functino to run in the background
@@ -196,8 +268,37 @@ class NotebookLSPHandler(WebSocketHandler):
     async def open(self, *args, **kwargs):
         notebook_path = self.get_argument('path', '')
         notebook_path = os.path.join(root_dir, notebook_path)
-        self.notebook_manager = NotebookManager(notebook_path)
-        await self.send_message('connection_established', {})
+        self.session_id = self.get_argument('session', '')
+
+        # a reconnecting client picks up the notebook manager it left behind
+        # instead of re-reading the notebook from disk and reopening it in the lsp
+        notebook_manager = notebook_sessions.get(self.session_id) if self.session_id else None
+        resumed = notebook_manager is not None
+        if notebook_manager is not None:
+            timer = release_timers.pop(self.session_id, None)
+            if timer is not None:
+                IOLoop.current().remove_timeout(timer)
+            logging.debug("[Copilot] Resuming notebook session %s", self.session_id)
+        else:
+            # carry the version forward from any other session on this notebook so it
+            # never goes backwards for the document uri
+            other_sessions = get_sessions_for_path(notebook_path)
+            document_version = max(
+                [other.document_version for other in other_sessions.values()], default=0)
+
+            # a session left behind for this notebook (e.g. by a page reload) is closed
+            # in the lsp first so the new didOpen doesn't land on an already open document
+            for session_id, other in other_sessions.items():
+                if other.owner is None:
+                    release_notebook_session(session_id)
+
+            notebook_manager = NotebookManager(notebook_path, document_version)
+            if self.session_id:
+                notebook_sessions[self.session_id] = notebook_manager
+
+        notebook_manager.owner = self
+        self.notebook_manager = notebook_manager
+        await self.send_message('connection_established', {'resumed': resumed})
         logging.debug("[Copilot] WebSocket opened")
 
     async def on_message(self, message):
@@ -225,6 +326,8 @@ class NotebookLSPHandler(WebSocketHandler):
                     await self.handle_cell_delete(data)
                 elif data['type'] == 'sync_request':
                     await self.handle_sync_request()
+                elif data['type'] == 'cell_sync':
+                    await self.handle_cell_sync(data)
                 elif data['type'] == 'change_path':
                     await self.handler_path_change(data);
                 elif data['type'] == 'set_language':
@@ -271,8 +374,16 @@ class NotebookLSPHandler(WebSocketHandler):
         if self.notebook_manager is None:
             raise Exception("Notebook manager not initialized")
 
-        code = self.notebook_manager.get_full_code()
-        await self.send_message('sync_response', {'code': code})
+        hashes = self.notebook_manager.get_cell_hashes()
+        await self.send_message('sync_response', {'hashes': hashes})
+
+    async def handle_cell_sync(self, data):
+        if self.notebook_manager is None:
+            raise Exception("Notebook manager not initialized")
+
+        # only bump the document version when the client actually had something new
+        if self.notebook_manager.sync_cells(data['cells'], data['cell_count']):
+            self.notebook_manager.send_full_update()
 
     async def handle_cell_add(self, data):
         if self.notebook_manager is None:
@@ -304,12 +415,38 @@ class NotebookLSPHandler(WebSocketHandler):
         if self.notebook_manager is None:
             raise Exception("Notebook manager not initialized")
 
-        # when socket is closed send the close signal to server
-        # unregister the lsp server restart callback
-        self.notebook_manager.send_close_signal()
-        lsp_client.unregister_restart_callback(self.notebook_manager._callback)
+        notebook_manager = self.notebook_manager
         self.notebook_manager = None
 
+        # a newer socket from the same client already took over this notebook
+        if notebook_manager.owner is not self:
+            return
+        notebook_manager.owner = None
+
+        # when socket is closed cleanly send the close signal to server
+        # and unregister the lsp server restart callback
+        if not self.session_id:
+            notebook_manager.send_close_signal()
+            lsp_client.unregister_restart_callback(notebook_manager._callback)
+            return
+
+        # a newer session opened this notebook while this socket was still hanging around
+        # its didOpen replaced this document in the lsp, so drop the manager without closing it
+        if get_sessions_for_path(notebook_manager.path, exclude=self.session_id):
+            notebook_sessions.pop(self.session_id, None)
+            lsp_client.unregister_restart_callback(notebook_manager._callback)
+            return
+
+        # 1000 is the normal close sent by dispose() when the notebook is closed
+        # anything else (including 1001 from proxies restarting) may still reconnect
+        if self.close_code == 1000:
+            release_notebook_session(self.session_id)
+            return
+
+        # otherwise the connection dropped, keep the notebook around for a reconnect
+        release_timers[self.session_id] = IOLoop.current().call_later(
+            SESSION_RETAIN_SECONDS, release_notebook_session, self.session_id)
+
 class AuthHandler(JupyterHandler):
     async def post(self):
         action = self.request.path.split("/")[-1]
@@ -247,7 +247,20 @@ const plugin: JupyterFrontEndPlugin<void> = {
       await notebook.context.ready;
 
       const wsURL = URLExt.join(serverSettings.wsUrl, 'jupyter-copilot', 'ws');
-      const client = new NotebookLSPClient(notebook.context.path, wsURL);
+      const client = new NotebookLSPClient(
+        notebook.context.path,
+        wsURL,
+        () => {
+          const sources: string[] = [];
+          const cells = notebook.model?.cells;
+          if (cells) {
+            for (let i = 0; i < cells.length; i++) {
+              sources.push(cells.get(i).sharedModel.getSource());
+            }
+          }
+          return sources;
+        }
+      );
       notebookClients.set(notebook.id, client);
 
       notebook.sessionContext.ready.then(() => {
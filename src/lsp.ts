@@ -6,6 +6,8 @@
     server when a cell is updated in the notebook frontend.
 */
 
+import { hashCellContent } from './utils';
+
 interface Completion {
   displayText: string;
   docVersion: number;
@@ -25,10 +27,24 @@ class NotebookLSPClient {
     { resolve: (value: any) => void; reject: (reason?: any) => void }
   > = new Map();
   private wsUrl: string;
-  private isReconnecting: boolean = false;
-
-  constructor(notebookPath: string, wsUrl: string) {
-    this.wsUrl = `${wsUrl}?path=${encodeURIComponent(notebookPath)}`;
+  // number of reconnects tried since the socket was last open, drives the backoff
+  private reconnectAttempts: number = 0;
+  private reconnectTimer: number | undefined;
+  private isDisposed: boolean = false;
+  // returns the current source of every cell in the notebook
+  private getCellSources: () => string[];
+
+  constructor(
+    notebookPath: string,
+    wsUrl: string,
+    getCellSources: () => string[]
+  ) {
+    // the session id lets the server hand a reconnecting socket the state it already holds
+    const sessionId = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    this.wsUrl =
+      `${wsUrl}?path=${encodeURIComponent(notebookPath)}` +
+      `&session=${sessionId}`;
+    this.getCellSources = getCellSources;
     this.initializeWebSocket();
   }
 
@@ -43,20 +59,29 @@ class NotebookLSPClient {
     }
 
     this.socket.onmessage = this.handleMessage.bind(this);
-    this.socket.onopen = () => this.sendMessage('sync_request', {});
+    this.socket.onopen = () => {
+      this.reconnectAttempts = 0;
+      this.sendMessage('sync_request', {});
+    };
     this.socket.onclose = this.handleSocketClose;
   }
 
+  // keep retrying with exponential backoff until the socket opens again or we are disposed
+  // the network is often not back on the first try after sleep/wake or a proxy drop
   private handleSocketClose = () => {
-    if (this.isReconnecting) {
+    if (this.isDisposed || this.reconnectTimer !== undefined) {
       return;
     }
-    this.isReconnecting = true;
-    this.initializeWebSocket();
-    console.debug('Socket closed, reconnecting...');
-    setTimeout(() => {
-      this.isReconnecting = false;
-    }, 4000);
+    const delay =
+      this.reconnectAttempts === 0
+        ? 0
+        : Math.min(500 * 2 ** this.reconnectAttempts, 30000);
+    this.reconnectAttempts++;
+    console.debug(`Socket closed, reconnecting in ${delay}ms...`);
+    this.reconnectTimer = window.setTimeout(() => {
+      this.reconnectTimer = undefined;
+      this.initializeWebSocket();
+    }, delay);
   };
 
   // Handle messages from the extension server
@@ -64,6 +89,7 @@ class NotebookLSPClient {
     const data = JSON.parse(event.data);
     switch (data.type) {
       case 'sync_response':
+        this.sendCellSync(data.hashes);
         break;
       case 'completion':
         {
@@ -97,6 +123,16 @@ class NotebookLSPClient {
     this.sendMessage('cell_add', { cell_id: cellID, content: content });
   }
 
+  // compares the server's cell hashes against the notebook and sends only the cells that differ
+  // the server resizes its cells to cell_count before applying them
+  private sendCellSync(hashes: string[]) {
+    const sources = this.getCellSources();
+    const cells = sources
+      .map((content, cellId) => ({ cell_id: cellId, content: content }))
+      .filter(cell => hashes[cell.cell_id] !== hashCellContent(cell.content));
+    this.sendMessage('cell_sync', { cells: cells, cell_count: sources.length });
+  }
+
   // sends a message to the server which will then send the updated code to the lsp server
   public sendUpdateLSPVersion() {
     this.sendMessage('update_lsp_version', {});
@@ -141,8 +177,11 @@ class NotebookLSPClient {
   }
 
   // cleans up the socket connection
+  // a normal close code tells the server it can drop the notebook right away
   public dispose() {
-    this.socket?.close();
+    this.isDisposed = true;
+    window.clearTimeout(this.reconnectTimer);
+    this.socket?.close(1000);
     console.debug('socket connection closed');
   }
 }
@@ -40,3 +40,28 @@ export const makePostRequest = async (route: string, body: object) => {
     throw reason;
   }
 };
+
+// lookup table for the standard (zlib) crc32 polynomial
+const CRC32_TABLE = (() => {
+  const table = new Uint32Array(256);
+  for (let i = 0; i < 256; i++) {
+    let c = i;
+    for (let k = 0; k < 8; k++) {
+      c = c & 1 ? 0xedb88320 ^ (c >>> 1) : c >>> 1;
+    }
+    table[i] = c >>> 0;
+  }
+  return table;
+})();
+
+// crc32 of the utf-8 encoded cell content prefixed with its byte length
+// this has to match hash_cell_content in jupyter_copilot/handlers.py
+export const hashCellContent = (content: string) => {
+  const data = new TextEncoder().encode(content);
+  let crc = 0xffffffff;
+  for (const byte of data) {
+    crc = CRC32_TABLE[(crc ^ byte) & 0xff] ^ (crc >>> 8);
+  }
+  crc = (crc ^ 0xffffffff) >>> 0;
+  return `${data.length}-${crc.toString(16).padStart(8, '0')}`;
+};